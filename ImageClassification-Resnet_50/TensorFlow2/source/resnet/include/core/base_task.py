@@ -18,15 +18,13 @@ import abc
 import functools
 from typing import Any, Callable, Optional
 
-import six
 import tensorflow as tf
 
 from modeling.hyperparams import config_definitions as cfg
 from utils import registry
 
 
-@six.add_metaclass(abc.ABCMeta)
-class Task(tf.Module):
+class Task(tf.Module, metaclass=abc.ABCMeta):
   """A single-replica view of training procedure.
 
   Tasks provide artifacts for training/evalution procedures, including
@@ -39,6 +37,11 @@ class Task(tf.Module):
 
   def __init__(self, params: cfg.TaskConfig):
     self._task_config = params
+    # Number of replicas in sync, bound once by `compile_model`.
+    self._num_replicas = None
+    # `model.metrics` of the compiled model, cached once the compiled metrics
+    # are built by their first update.
+    self._metrics_list = None
 
   @property
   def task_config(self) -> cfg.TaskConfig:
@@ -71,6 +74,7 @@ class Task(tf.Module):
                     loss=None,
                     train_step: Optional[Callable[..., Any]] = None,
                     validation_step: Optional[Callable[..., Any]] = None,
+                    jit_compile: bool = False,
                     **kwargs) -> tf.keras.Model:
     """Compiles the model with objects created by the task.
 
@@ -83,6 +87,11 @@ class Task(tf.Module):
       train_step: optional train step function defined by the task.
       validation_step: optional validation_step step function defined by the
         task.
+      jit_compile: whether to XLA compile the forward and backward pass of the
+        task's own `train_step`, and the forward pass of its own
+        `validation_step` when one is passed. Every op of the model and the
+        losses must be supported by XLA. Drivers would usually pass
+        `RuntimeConfig.enable_xla`.
       **kwargs: other kwargs consumed by keras.Model compile().
 
     Returns:
@@ -91,8 +100,41 @@ class Task(tf.Module):
     if bool(loss is None) == bool(train_step is None):
       raise ValueError("`loss` and `train_step` should be exclusive to "
                        "each other.")
+    is_task_train_step = (
+        getattr(train_step, "__func__", None) is Task.train_step)
+    if jit_compile and not is_task_train_step:
+      raise ValueError("`jit_compile` requires the task's own `train_step`.")
     model.compile(optimizer=optimizer, loss=loss, **kwargs)
-
+    self._num_replicas = float(
+        tf.distribute.get_strategy().num_replicas_in_sync)
+    self._metrics_list = None
+
+    if is_task_train_step:
+      forward_backward = self._make_forward_backward(model, model.optimizer)
+      if jit_compile:
+        # Only the per-replica forward and backward pass is compiled. The
+        # gradient allreduce and `apply_gradients` are cross-replica sync
+        # points and stay in the function Keras traces.
+        forward_backward = tf.function(
+            forward_backward, experimental_compile=True)
+      train_step = functools.partial(
+          self._apply_train_step, metrics=None,
+          forward_backward=forward_backward)
+    if jit_compile and (getattr(validation_step, "__func__", None) is
+                        Task.validation_step):
+      # As in training, only the model forward pass is compiled; the losses
+      # and metric updates stay in the function Keras traces.
+      validation_step = functools.partial(
+          self._apply_validation_step, metrics=None,
+          forward=tf.function(
+              functools.partial(self.inference_step, model=model),
+              experimental_compile=True))
+
+    # Keras runs `train_step` and `test_step` through `strategy.run` inside
+    # its own `tf.function`, so they are bound as plain callables. Wrapping
+    # them in another `tf.function` would hide the allreduce and
+    # `apply_gradients` sync points in a nested graph, where `merge_call`
+    # fails under MirroredStrategy.
     if train_step:
       model.train_step = functools.partial(
           train_step, model=model, optimizer=model.optimizer)
@@ -129,11 +171,12 @@ class Task(tf.Module):
     """
     del model_outputs, labels
 
-    if aux_losses is None:
-      losses = [tf.constant(0.0, dtype=tf.float32)]
-    else:
-      losses = aux_losses
-    total_loss = tf.add_n(losses)
+    # Avoids an `add_n` node in the traced step when there is nothing to sum.
+    if not aux_losses:
+      return tf.zeros([], dtype=tf.float32)
+    if len(aux_losses) == 1:
+      return aux_losses[0]
+    total_loss = tf.add_n(aux_losses)
     return total_loss
 
   def build_metrics(self, training: bool = True):
@@ -176,44 +219,110 @@ class Task(tf.Module):
       inputs: a dictionary of input tensors.
       model: the model, forward pass definition.
       optimizer: the optimizer for this training step.
-      metrics: a nested structure of metrics objects.
+      metrics: a nested structure of metrics objects. Their states are updated
+        but their results are not added to the returned logs.
 
     Returns:
       A dictionary of logs.
     """
-    if isinstance(inputs, tuple) and len(inputs) == 2:
-      features, labels = inputs
-    else:
-      features, labels = inputs, inputs
+    return self._apply_train_step(
+        inputs, model, optimizer, metrics,
+        self._make_forward_backward(model, optimizer))
+
+  def _make_forward_backward(self, model, optimizer):
+    """Returns `_forward_backward` bound to `model` and `optimizer`.
+
+    The optimizer kind is resolved here, so the traced step has no Python
+    branch on it.
+    """
+    use_loss_scale = isinstance(
+        optimizer, tf.keras.mixed_precision.experimental.LossScaleOptimizer)
+
+    def forward_backward(features, labels, replica_scale):
+      return self._forward_backward(features, labels, replica_scale, model,
+                                    optimizer, use_loss_scale)
+
+    return forward_backward
+
+  def _forward_backward(self, features, labels, replica_scale, model,
+                        optimizer, use_loss_scale):
+    """Runs the forward and backward pass of one replica.
+
+    Args:
+      features: the model inputs.
+      labels: the labels passed to `build_losses`.
+      replica_scale: a python float the loss is multiplied by before taking
+        gradients, so that summing them over replicas averages them.
+      model: the keras.Model.
+      optimizer: the optimizer for this training step.
+      use_loss_scale: whether `optimizer` is a `LossScaleOptimizer` whose loss
+        scale is applied as well.
+
+    Returns:
+      A tuple of the float32 model outputs, the loss, the gradients of the
+      scaled loss and the optimizer loss scale, or None if `use_loss_scale` is
+      False.
+    """
     with tf.GradientTape() as tape:
       outputs = model(features, training=True)
+      # Keeps the loss in float32 under float16/bfloat16 mixed precision.
+      outputs = _cast_floating_to_float32(outputs)
       # Computes per-replica loss.
       loss = self.build_losses(
           labels=labels, model_outputs=outputs, aux_losses=model.losses)
-      # Scales loss as the default gradients allreduce performs sum inside the
-      # optimizer.
-      scaled_loss = loss / tf.distribute.get_strategy().num_replicas_in_sync
+      loss_scale = replica_scale
 
       # For mixed precision, when a LossScaleOptimizer is used, the loss is
-      # scaled to avoid numeric underflow.
-      if isinstance(optimizer,
-                    tf.keras.mixed_precision.experimental.LossScaleOptimizer):
-        scaled_loss = optimizer.get_scaled_loss(scaled_loss)
-
+      # scaled to avoid numeric underflow. The replica and loss scales are
+      # folded into a single multiply.
+      optimizer_loss_scale = None
+      if use_loss_scale:
+        optimizer_loss_scale = tf.cast(optimizer.loss_scale(), loss.dtype)
+        loss_scale *= optimizer_loss_scale
+      scaled_loss = loss * loss_scale
+    grads = tape.gradient(scaled_loss, model.trainable_variables)
+    return outputs, loss, grads, optimizer_loss_scale
+
+  def _apply_train_step(self, inputs, model, optimizer, metrics,
+                        forward_backward):
+    """Runs `forward_backward`, then allreduces and applies the gradients."""
+    if isinstance(inputs, tuple) and len(inputs) == 2:
+      features, labels = inputs
+    else:
+      features, labels = inputs, inputs
+    # Scales loss as the gradient allreduce below performs sum.
+    num_replicas = (
+        self._num_replicas or
+        tf.distribute.get_strategy().num_replicas_in_sync)
+    outputs, loss, grads, optimizer_loss_scale = forward_backward(
+        features, labels, 1.0 / num_replicas)
+
+    # Read on every call, so custom loops always update the model they pass in
+    # with its current `trainable` settings. Under `tf.function` the list is
+    # only built while tracing.
     tvars = model.trainable_variables
-    grads = tape.gradient(scaled_loss, tvars)
-
-    if isinstance(optimizer,
-                  tf.keras.mixed_precision.experimental.LossScaleOptimizer):
-      grads = optimizer.get_unscaled_gradients(grads)
-    optimizer.apply_gradients(list(zip(grads, tvars)))
+    # Gradients are summed across replicas in the compute dtype of the mixed
+    # precision policy, which halves the allreduce payload for float16 and
+    # bfloat16. They are reduced still loss scaled, so small gradients do not
+    # flush to zero in float16. A sum that overflows is non-finite, and the
+    # LossScaleOptimizer skips the step and lowers the loss scale.
+    grads, tvars = _allreduce_gradients(
+        grads, tvars,
+        tf.keras.mixed_precision.experimental.global_policy().compute_dtype)
+    if optimizer_loss_scale is not None:
+      # Unscales in the variable dtype, after the float16 allreduce.
+      inv_loss_scale = 1.0 / optimizer_loss_scale
+      grads = [_multiply_gradient(g, inv_loss_scale) for g in grads]
+    optimizer.apply_gradients(
+        zip(grads, tvars), experimental_aggregate_gradients=False)
     logs = {self.loss: loss}
     if metrics:
+      # Only the streaming states are updated here; callers owning `metrics`
+      # read `result()` at their logging boundaries.
       self.process_metrics(metrics, labels, outputs)
-      logs.update({m.name: m.result() for m in metrics})
     elif model.compiled_metrics:
       self.process_compiled_metrics(model.compiled_metrics, labels, outputs)
-      logs.update({m.name: m.result() for m in model.metrics})
+      logs.update({m.name: m.result() for m in self._get_metrics_list(model)})
     return logs
 
   def validation_step(self, inputs, model: tf.keras.Model, metrics=None):
@@ -227,11 +336,17 @@ class Task(tf.Module):
     Returns:
       A dictionary of logs.
     """
+    return self._apply_validation_step(
+        inputs, model, metrics,
+        functools.partial(self.inference_step, model=model))
+
+  def _apply_validation_step(self, inputs, model, metrics, forward):
+    """Runs `forward` on the features, then computes the loss and metrics."""
     if isinstance(inputs, tuple) and len(inputs) == 2:
       features, labels = inputs
     else:
       features, labels = inputs, inputs
-    outputs = self.inference_step(features, model)
+    outputs = _cast_floating_to_float32(forward(features))
     loss = self.build_losses(
         labels=labels, model_outputs=outputs, aux_losses=model.losses)
     logs = {self.loss: loss}
@@ -240,14 +355,89 @@ class Task(tf.Module):
       logs.update({m.name: m.result() for m in metrics})
     elif model.compiled_metrics:
       self.process_compiled_metrics(model.compiled_metrics, labels, outputs)
-      logs.update({m.name: m.result() for m in model.metrics})
+      logs.update({m.name: m.result() for m in self._get_metrics_list(model)})
     return logs
 
+  def _get_metrics_list(self, model: tf.keras.Model):
+    """Returns `model.metrics`, looked up once after they are built."""
+    if self._metrics_list is None:
+      self._metrics_list = tuple(model.metrics)
+    return self._metrics_list
+
   def inference_step(self, inputs, model: tf.keras.Model):
     """Performs the forward step."""
     return model(inputs, training=False)
 
 
+def _cast_floating_to_float32(outputs):
+  """Casts the floating point tensors of a nested structure to float32."""
+  return tf.nest.map_structure(
+      lambda x: tf.cast(x, tf.float32) if x.dtype.is_floating else x, outputs)
+
+
+def _multiply_gradient(gradient, scale):
+  """Multiplies a dense or sparse gradient by a scalar, passing None through."""
+  if gradient is None:
+    return None
+  if isinstance(gradient, tf.IndexedSlices):
+    return tf.IndexedSlices(
+        gradient.values * tf.cast(scale, gradient.values.dtype),
+        gradient.indices,
+        dense_shape=gradient.dense_shape)
+  return gradient * tf.cast(scale, gradient.dtype)
+
+
+def _allreduce_gradients(grads, tvars, allreduce_dtype):
+  """Sums non-None gradients across replicas.
+
+  Dense gradients are cast to `allreduce_dtype` and packed into a single flat
+  buffer, so one allreduce is issued per step instead of one per variable.
+  `tf.IndexedSlices` gradients are reduced separately and stay sparse. With a
+  single replica the gradients are returned as they are.
+
+  Args:
+    grads: a list of gradients, possibly containing None.
+    tvars: the variables matching `grads`.
+    allreduce_dtype: the dtype dense gradients are cast to for the allreduce.
+
+  Returns:
+    A tuple of the allreduced gradients, dense ones cast back to the variable
+    dtypes, and the matching variables.
+  """
+  grads_and_vars = [(g, v) for g, v in zip(grads, tvars) if g is not None]
+  if not grads_and_vars:
+    raise ValueError("No gradients provided for any variable: %s." %
+                     ([v.name for v in tvars],))
+  replica_context = tf.distribute.get_replica_context()
+  if replica_context.num_replicas_in_sync == 1:
+    return [g for g, _ in grads_and_vars], [v for _, v in grads_and_vars]
+
+  dense = [(i, g, v) for i, (g, v) in enumerate(grads_and_vars)
+           if not isinstance(g, tf.IndexedSlices)]
+  sparse = [(i, g, v) for i, (g, v) in enumerate(grads_and_vars)
+            if isinstance(g, tf.IndexedSlices)]
+  reduced = [None] * len(grads_and_vars)
+  if dense:
+    sizes = [v.shape.num_elements() for _, _, v in dense]
+    flat_grads = tf.concat([
+        tf.reshape(tf.cast(g, allreduce_dtype), [-1]) for _, g, _ in dense
+    ], axis=0)
+    flat_grads = replica_context.all_reduce(
+        tf.distribute.ReduceOp.SUM, flat_grads)
+    for (i, _, v), g in zip(dense, tf.split(flat_grads, sizes)):
+      reduced[i] = tf.cast(tf.reshape(g, v.shape), v.dtype)
+  if sparse:
+    # `ReplicaContext.all_reduce` densifies `tf.IndexedSlices`, so they are
+    # batch reduced in cross-replica context instead.
+    sparse_grads = replica_context.merge_call(
+        lambda strategy, grads_and_vars: strategy.extended.batch_reduce_to(
+            tf.distribute.ReduceOp.SUM, grads_and_vars),
+        args=([(g, v) for _, g, v in sparse],))
+    for (i, _, _), g in zip(sparse, sparse_grads):
+      reduced[i] = g
+  return reduced, [v for _, v in grads_and_vars]
+
+
 _REGISTERED_TASK_CLS = {}
 
 
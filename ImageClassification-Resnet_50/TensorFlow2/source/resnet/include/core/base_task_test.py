@@ -0,0 +1,162 @@
+# Copyright 2020 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for core.base_task."""
+
+from absl.testing import parameterized
+import tensorflow as tf
+
+from core import base_task
+from modeling.hyperparams import config_definitions as cfg
+
+
+def setUpModule():
+  # Two logical CPUs, so MirroredStrategy runs a real two-replica allreduce.
+  cpus = tf.config.experimental.list_physical_devices("CPU")
+  tf.config.experimental.set_virtual_device_configuration(
+      cpus[0], [tf.config.experimental.VirtualDeviceConfiguration()] * 2)
+
+
+def get_strategy(distribution):
+  if distribution == "mirrored":
+    return tf.distribute.MirroredStrategy(["/cpu:0", "/cpu:1"])
+  return tf.distribute.get_strategy()
+
+
+class MyTask(base_task.Task):
+  """Fits y = w * x with loss mean(y), so every step's gradient is mean(x)."""
+
+  def build_model(self):
+    inputs = tf.keras.layers.Input(shape=(1,), name="input")
+    outputs = tf.keras.layers.Dense(
+        1, use_bias=False, kernel_initializer="ones", name="dense")(inputs)
+    return tf.keras.Model(inputs, outputs)
+
+  def build_inputs(self, params, input_context=None):
+    del params, input_context
+    dataset = tf.data.Dataset.from_tensors((tf.fill([1], 3.0), tf.zeros([1])))
+    return dataset.repeat().batch(2)
+
+  def build_losses(self, labels, model_outputs, aux_losses=None):
+    del labels, aux_losses
+    return tf.reduce_mean(model_outputs)
+
+
+class SmallLossTask(MyTask):
+  """MyTask with the loss, and so the gradient, multiplied by 1e-8."""
+
+  def build_losses(self, labels, model_outputs, aux_losses=None):
+    return 1e-8 * super(SmallLossTask, self).build_losses(
+        labels, model_outputs, aux_losses)
+
+
+class BaseTaskTest(tf.test.TestCase, parameterized.TestCase):
+
+  @parameterized.parameters(("default", False), ("default", True),
+                            ("mirrored", False), ("mirrored", True))
+  def test_compile_model_and_fit(self, distribution, jit_compile):
+    strategy = get_strategy(distribution)
+    with strategy.scope():
+      task = MyTask(cfg.TaskConfig())
+      model = task.build_model()
+      optimizer = tf.keras.optimizers.SGD(learning_rate=1.0)
+      task.compile_model(
+          model, optimizer, train_step=task.train_step,
+          validation_step=task.validation_step, jit_compile=jit_compile)
+    history = model.fit(
+        task.build_inputs(None), epochs=1, steps_per_epoch=1, verbose=0)
+    self.assertAllClose(history.history["loss"], [3.0])
+    # The gradient is mean(x) = 3 whatever the number of replicas.
+    self.assertAllClose(model.get_layer("dense").kernel, [[-2.0]])
+    logs = model.evaluate(
+        task.build_inputs(None), steps=1, verbose=0, return_dict=True)
+    self.assertAllClose(logs["loss"], -6.0)
+
+  def test_jit_compile_requires_task_train_step(self):
+    task = MyTask(cfg.TaskConfig())
+    model = task.build_model()
+    with self.assertRaisesRegex(ValueError, "jit_compile"):
+      task.compile_model(
+          model, tf.keras.optimizers.SGD(), train_step=lambda *a, **kw: {},
+          jit_compile=True)
+
+  def test_mixed_float16_allreduce_keeps_small_gradients(self):
+    tf.keras.mixed_precision.experimental.set_policy("mixed_float16")
+    self.addCleanup(
+        tf.keras.mixed_precision.experimental.set_policy, "float32")
+    strategy = get_strategy("mirrored")
+    with strategy.scope():
+      task = SmallLossTask(cfg.TaskConfig())
+      model = task.build_model()
+      optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(
+          tf.keras.optimizers.SGD(learning_rate=1e7), "dynamic")
+      task.compile_model(model, optimizer, train_step=task.train_step)
+    model.fit(task.build_inputs(None), epochs=1, steps_per_epoch=1, verbose=0)
+    # The gradient is 3e-8, 1.5e-8 per replica, which is zero in float16
+    # unless it is still multiplied by the loss scale when allreduced.
+    self.assertAllClose(
+        model.get_layer("dense").kernel, [[0.7]], atol=1e-3)
+    self.assertEqual(self.evaluate(optimizer.loss_scale()), 2.0**15)
+
+  def test_train_step_updates_model_passed_in(self):
+    task = MyTask(cfg.TaskConfig())
+    optimizer = tf.keras.optimizers.SGD(learning_rate=1.0)
+    inputs = (tf.fill([2, 1], 3.0), tf.zeros([2, 1]))
+    model_a = task.build_model()
+    model_b = task.build_model()
+
+    task.train_step(inputs, model=model_a, optimizer=optimizer)
+    task.train_step(inputs, model=model_b, optimizer=optimizer)
+    self.assertAllClose(model_a.get_layer("dense").kernel, [[-2.0]])
+    self.assertAllClose(model_b.get_layer("dense").kernel, [[-2.0]])
+
+    # Freezing the only layer leaves nothing to train on the next step.
+    model_b.get_layer("dense").trainable = False
+    with self.assertRaisesRegex(ValueError, "No gradients"):
+      task.train_step(inputs, model=model_b, optimizer=optimizer)
+    self.assertAllClose(model_b.get_layer("dense").kernel, [[-2.0]])
+
+  @parameterized.parameters("default", "mirrored")
+  def test_allreduce_gradients_keeps_sparse_gradients(self, distribution):
+    strategy = get_strategy(distribution)
+    with strategy.scope():
+      dense_var = tf.Variable([1.0, 2.0])
+      sparse_var = tf.Variable([[1.0], [2.0], [3.0]])
+
+    def replica_fn():
+      grads = [
+          tf.constant([1.0, 2.0]),
+          tf.IndexedSlices(
+              tf.constant([[1.0]]), tf.constant([1]),
+              dense_shape=tf.constant([3, 1])),
+          None,
+      ]
+      grads, tvars = base_task._allreduce_gradients(
+          grads, [dense_var, sparse_var, dense_var], tf.float16)
+      self.assertLen(tvars, 2)
+      self.assertIsInstance(grads[1], tf.IndexedSlices)
+      return grads[0], tf.convert_to_tensor(grads[1])
+
+    dense, sparse = tf.function(lambda: strategy.run(replica_fn))()
+    num_replicas = strategy.num_replicas_in_sync
+    self.assertAllClose(
+        strategy.experimental_local_results(dense)[0],
+        [num_replicas, 2.0 * num_replicas])
+    self.assertAllClose(
+        strategy.experimental_local_results(sparse)[0],
+        [[0.0], [num_replicas], [0.0]])
+
+
+if __name__ == "__main__":
+  tf.test.main()
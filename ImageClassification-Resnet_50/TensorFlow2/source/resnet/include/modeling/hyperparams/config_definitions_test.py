@@ -0,0 +1,41 @@
+# Lint as: python3
+# Copyright 2020 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for config_definitions.py."""
+
+from absl.testing import parameterized
+import dataclasses
+import tensorflow as tf
+from modeling.hyperparams import config_definitions as cfg
+
+
+class ConfigDefinitionsTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.parameters(
+      (cfg.TrainerConfig, 'optimizer_config'),
+      (cfg.TaskConfig, 'train_data'),
+      (cfg.TaskConfig, 'validation_data'),
+      (cfg.ExperimentConfig, 'task'),
+      (cfg.ExperimentConfig, 'trainer'),
+      (cfg.ExperimentConfig, 'runtime'),
+  )
+  def test_sub_config_uses_default_factory(self, config_cls, name):
+    field = {f.name: f for f in dataclasses.fields(config_cls)}[name]
+    self.assertIs(field.default, dataclasses.MISSING)
+    self.assertIsNot(field.default_factory, dataclasses.MISSING)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -42,11 +42,15 @@ class OptimizerConfig(oneof.OneOfConfig):
     rmsprop: rmsprop optimizer.
   """
   type: Optional[str] = None
-  sgd: opt_cfg.SGDConfig = opt_cfg.SGDConfig()
-  adam: opt_cfg.AdamConfig = opt_cfg.AdamConfig()
-  adamw: opt_cfg.AdamWeightDecayConfig = opt_cfg.AdamWeightDecayConfig()
-  lamb: opt_cfg.LAMBConfig = opt_cfg.LAMBConfig()
-  rmsprop: opt_cfg.RMSPropConfig = opt_cfg.RMSPropConfig()
+  sgd: opt_cfg.SGDConfig = dataclasses.field(default_factory=opt_cfg.SGDConfig)
+  adam: opt_cfg.AdamConfig = dataclasses.field(
+      default_factory=opt_cfg.AdamConfig)
+  adamw: opt_cfg.AdamWeightDecayConfig = dataclasses.field(
+      default_factory=opt_cfg.AdamWeightDecayConfig)
+  lamb: opt_cfg.LAMBConfig = dataclasses.field(
+      default_factory=opt_cfg.LAMBConfig)
+  rmsprop: opt_cfg.RMSPropConfig = dataclasses.field(
+      default_factory=opt_cfg.RMSPropConfig)
 
 
 @dataclasses.dataclass
@@ -61,10 +65,14 @@ class LrConfig(oneof.OneOfConfig):
     cosine: cosine learning rate config.
   """
   type: Optional[str] = None
-  stepwise: lr_cfg.StepwiseLrConfig = lr_cfg.StepwiseLrConfig()
-  exponential: lr_cfg.ExponentialLrConfig = lr_cfg.ExponentialLrConfig()
-  polynomial: lr_cfg.PolynomialLrConfig = lr_cfg.PolynomialLrConfig()
-  cosine: lr_cfg.CosineLrConfig = lr_cfg.CosineLrConfig()
+  stepwise: lr_cfg.StepwiseLrConfig = dataclasses.field(
+      default_factory=lr_cfg.StepwiseLrConfig)
+  exponential: lr_cfg.ExponentialLrConfig = dataclasses.field(
+      default_factory=lr_cfg.ExponentialLrConfig)
+  polynomial: lr_cfg.PolynomialLrConfig = dataclasses.field(
+      default_factory=lr_cfg.PolynomialLrConfig)
+  cosine: lr_cfg.CosineLrConfig = dataclasses.field(
+      default_factory=lr_cfg.CosineLrConfig)
 
 
 @dataclasses.dataclass
@@ -77,8 +85,10 @@ class WarmupConfig(oneof.OneOfConfig):
     polynomial: polynomial warmup config.
   """
   type: Optional[str] = None
-  linear: lr_cfg.LinearWarmupConfig = lr_cfg.LinearWarmupConfig()
-  polynomial: lr_cfg.PolynomialWarmupConfig = lr_cfg.PolynomialWarmupConfig()
+  linear: lr_cfg.LinearWarmupConfig = dataclasses.field(
+      default_factory=lr_cfg.LinearWarmupConfig)
+  polynomial: lr_cfg.PolynomialWarmupConfig = dataclasses.field(
+      default_factory=lr_cfg.PolynomialWarmupConfig)
 
 
 @dataclasses.dataclass
@@ -90,6 +100,7 @@ class OptimizationConfig(base_config.Config):
     learning_rate: learning rate oneof config.
     warmup: warmup oneof config.
   """
-  optimizer: OptimizerConfig = OptimizerConfig()
-  learning_rate: LrConfig = LrConfig()
-  warmup: WarmupConfig = WarmupConfig()
+  optimizer: OptimizerConfig = dataclasses.field(
+      default_factory=OptimizerConfig)
+  learning_rate: LrConfig = dataclasses.field(default_factory=LrConfig)
+  warmup: WarmupConfig = dataclasses.field(default_factory=WarmupConfig)
@@ -15,6 +15,7 @@
 # ==============================================================================
 """Tests for optimization_config.py."""
 
+import dataclasses
 import tensorflow as tf
 
 from modeling.optimization.configs import learning_rate_config as lr_cfg
@@ -57,5 +58,20 @@ class OptimizerConfigTest(tf.test.TestCase):
     self.assertEqual(opt_config.warmup.get(),
                      lr_cfg.LinearWarmupConfig())
 
+  def test_sub_configs_use_default_factory(self):
+    # Eager defaults are built at import and, as unhashable dataclass
+    # instances, rejected by `dataclasses` on Python 3.11.
+    for config_cls in (optimization_config.OptimizerConfig,
+                       optimization_config.LrConfig,
+                       optimization_config.WarmupConfig,
+                       optimization_config.OptimizationConfig):
+      for field in dataclasses.fields(config_cls):
+        if field.name == 'type':
+          continue
+        with self.subTest(config=config_cls.__name__, field=field.name):
+          self.assertIs(field.default, dataclasses.MISSING)
+          self.assertIsNot(field.default_factory, dataclasses.MISSING)
+
+
 if __name__ == '__main__':
   tf.test.main()
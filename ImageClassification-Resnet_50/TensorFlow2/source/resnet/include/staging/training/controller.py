@@ -19,6 +19,7 @@ from __future__ import division
 # from __future__ import google_type_annotations
 from __future__ import print_function
 
+import concurrent.futures
 import time
 
 from absl import logging
@@ -53,6 +54,7 @@ class Controller(object):
       eval_summary_dir: Optional[Text] = None,
       eval_steps: Optional[int] = None,
       eval_interval: Optional[int] = None,
+      async_checkpoint: bool = False,
 ############## TBD INSTRUMENTATION BEGIN ################
       profile_step: Optional[int] = None):
 ############## TBD INSTRUMENTATION END ################
@@ -87,6 +89,9 @@ class Controller(object):
         in the middle of training. Note that evaluation only happens outside the
         training loop, which the loop iteration is specify by `steps_per_loop`
         parameter.
+      async_checkpoint: Whether to write checkpoints on a background thread.
+        The write overlaps with evaluation and summaries, and is waited for
+        before the next training loop updates the variables.
 
     Raises:
       ValueError: If both `train_fn` and `eval_fn` are None.
@@ -119,6 +124,10 @@ class Controller(object):
     self.global_step = global_step
     self.checkpoint_manager = checkpoint_manager
     self.profile_step = profile_step
+    self._checkpoint_executor = (
+        concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if async_checkpoint else None)
+    self._pending_checkpoint = None
 
 ############## TBD INSTRUMENTATION BEGIN ################
     if self.profile_step is not None and self.profile_step % steps_per_loop != 0:
@@ -211,10 +220,28 @@ class Controller(object):
 
   def _maybe_save_checkpoints(self, current_step, force_trigger=False):
     if self.checkpoint_manager and self.checkpoint_manager.checkpoint_interval:
-      ckpt_path = self.checkpoint_manager.save(
-          checkpoint_number=current_step, check_interval=not force_trigger)
-      if ckpt_path is not None:
-        logging.info("Saved checkpoins in %s", ckpt_path)
+      if self._checkpoint_executor is None:
+        self._save_checkpoint(current_step, force_trigger)
+      else:
+        self._wait_for_checkpoint()
+        self._pending_checkpoint = self._checkpoint_executor.submit(
+            self._save_checkpoint, current_step, force_trigger)
+
+  def _save_checkpoint(self, current_step, force_trigger):
+    ckpt_path = self.checkpoint_manager.save(
+        checkpoint_number=current_step, check_interval=not force_trigger)
+    if ckpt_path is not None:
+      logging.info("Saved checkpoins in %s", ckpt_path)
+
+  def _wait_for_checkpoint(self):
+    """Blocks until a checkpoint written in the background is saved.
+
+    Raises:
+      Any exception raised while writing the checkpoint.
+    """
+    pending_checkpoint, self._pending_checkpoint = self._pending_checkpoint, None
+    if pending_checkpoint is not None:
+      pending_checkpoint.result()
 
   def _maybe_evaluate(self, current_step, force_trigger=False):
     if self.eval_trigger(current_step, force_trigger):
@@ -252,6 +279,9 @@ class Controller(object):
     logging.info("Train at step %s of %s", current_step, self.train_steps)
 
     while current_step < self.train_steps:
+      # The variables must not change while a checkpoint is being written.
+      self._wait_for_checkpoint()
+
       # Calculates steps to run for the next train loop.
       steps_per_loop = min(self.train_steps - current_step, self.steps_per_loop)
       logging.info("Entering training loop with %s steps, at step %s of %s",
@@ -306,6 +336,7 @@ class Controller(object):
     self._maybe_save_checkpoints(current_step, force_trigger=True)
     if evaluate:
       self._maybe_evaluate(current_step, force_trigger=True)
+    self._wait_for_checkpoint()
 ############## TBD INSTRUMENTATION END ################
 
   def evaluate(self, continuous=False, timeout_fn=None):
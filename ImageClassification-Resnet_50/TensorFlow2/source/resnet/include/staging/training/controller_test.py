@@ -19,6 +19,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import threading
 
 from absl.testing import parameterized
 import numpy as np
@@ -270,6 +271,114 @@ class ControllerTest(tf.test.TestCase, parameterized.TestCase):
     self.assertFalse(
         tf.io.gfile.exists(os.path.join(self.model_dir, "summaries/eval")))
 
+  @combinations.generate(all_strategy_combinations())
+  def test_train_with_async_checkpoint(self, strategy):
+    with strategy.scope():
+      test_runnable = TestRunnable()
+
+    checkpoint = tf.train.Checkpoint(
+        model=test_runnable.model, optimizer=test_runnable.optimizer)
+    checkpoint_manager = tf.train.CheckpointManager(
+        checkpoint,
+        self.model_dir,
+        max_to_keep=None,
+        step_counter=test_runnable.global_step,
+        checkpoint_interval=2)
+    test_controller = controller.Controller(
+        strategy=strategy,
+        train_fn=test_runnable.train,
+        global_step=test_runnable.global_step,
+        train_steps=10,
+        steps_per_loop=2,
+        checkpoint_manager=checkpoint_manager,
+        async_checkpoint=True,
+    )
+    test_controller.train(evaluate=False)
+
+    # All checkpoints are written by the time `train` returns.
+    self.assertEqual(checkpoint_manager.latest_checkpoint,
+                     os.path.join(self.model_dir, "ckpt-10"))
+
+  @combinations.generate(all_strategy_combinations())
+  def test_async_checkpoint_overlaps_evaluation(self, strategy):
+    with strategy.scope():
+      test_runnable = TestRunnable()
+
+    checkpoint = tf.train.Checkpoint(
+        model=test_runnable.model, optimizer=test_runnable.optimizer)
+    checkpoint_manager = tf.train.CheckpointManager(
+        checkpoint,
+        self.model_dir,
+        max_to_keep=None,
+        step_counter=test_runnable.global_step,
+        checkpoint_interval=2)
+
+    # The first save only completes once the evaluation that follows it has
+    # started, which a synchronous save would wait for until the timeout.
+    evaluated = threading.Event()
+    save_overlapped = []
+    save = checkpoint_manager.save
+
+    def save_after_evaluation(*args, **kwargs):
+      save_overlapped.append(evaluated.wait(timeout=10))
+      return save(*args, **kwargs)
+
+    def evaluate(num_steps):
+      evaluated.set()
+      return test_runnable.evaluate(num_steps)
+
+    checkpoint_manager.save = save_after_evaluation
+    test_controller = controller.Controller(
+        strategy=strategy,
+        train_fn=test_runnable.train,
+        eval_fn=evaluate,
+        global_step=test_runnable.global_step,
+        train_steps=4,
+        steps_per_loop=2,
+        checkpoint_manager=checkpoint_manager,
+        summary_dir=os.path.join(self.model_dir, "summaries/train"),
+        eval_summary_dir=os.path.join(self.model_dir, "summaries/eval"),
+        eval_steps=2,
+        eval_interval=2,
+        async_checkpoint=True,
+    )
+    test_controller.train(evaluate=True)
+
+    self.assertTrue(save_overlapped[0])
+    self.assertEqual(checkpoint_manager.latest_checkpoint,
+                     os.path.join(self.model_dir, "ckpt-4"))
+
+  def test_async_checkpoint_error_raised_on_wait(self):
+    test_runnable = TestRunnable()
+    checkpoint = tf.train.Checkpoint(model=test_runnable.model)
+    checkpoint_manager = tf.train.CheckpointManager(
+        checkpoint,
+        self.model_dir,
+        max_to_keep=None,
+        step_counter=test_runnable.global_step,
+        checkpoint_interval=2)
+
+    def failing_save(*args, **kwargs):
+      del args, kwargs
+      raise IOError("checkpoint write failed")
+
+    checkpoint_manager.save = failing_save
+    test_controller = controller.Controller(
+        train_fn=test_runnable.train,
+        global_step=test_runnable.global_step,
+        train_steps=10,
+        steps_per_loop=2,
+        checkpoint_manager=checkpoint_manager,
+        async_checkpoint=True,
+    )
+
+    # The save is only submitted here; its error surfaces on the next wait.
+    test_controller._maybe_save_checkpoints(2, force_trigger=True)
+    with self.assertRaisesRegex(IOError, "checkpoint write failed"):
+      test_controller._wait_for_checkpoint()
+    with self.assertRaisesRegex(IOError, "checkpoint write failed"):
+      test_controller.train(evaluate=False)
+
   @combinations.generate(all_strategy_combinations())
   def test_evaluate_only(self, strategy):
     with strategy.scope():
@@ -124,8 +124,16 @@ def process_record_dataset(dataset,
 
   options = tf.data.Options()
   options.experimental_slack = tf_data_experimental_slack
+  options.experimental_optimization.map_and_batch_fusion = True
+  if is_training:
+    # Training examples are shuffled anyway, so let the parallel interleave
+    # and map produce elements out of order instead of waiting on stragglers.
+    options.experimental_deterministic = False
   dataset = dataset.with_options(options)
 
+  # The host to device copy is overlapped by the distributed iterator, which
+  # prefetches each replica's batches onto its device. This dataset must stay
+  # on the host for `experimental_distribute_datasets_from_function`.
   return dataset
 
 
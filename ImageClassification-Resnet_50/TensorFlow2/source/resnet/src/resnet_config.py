@@ -46,16 +46,18 @@ class ResNetModelConfig(base_configs.ModelConfig):
           'use_l2_regularizer': True,
           'rescale_inputs': False,
       })
-  loss: base_configs.LossConfig = base_configs.LossConfig(
-      name='sparse_categorical_crossentropy')
-  optimizer: base_configs.OptimizerConfig = base_configs.OptimizerConfig(
-      name='momentum',
-      decay=0.9,
-      epsilon=0.001,
-      momentum=0.9,
-      moving_average_decay=None)
-  learning_rate: base_configs.LearningRateConfig = (
-      base_configs.LearningRateConfig(
+  loss: base_configs.LossConfig = dataclasses.field(
+      default_factory=lambda: base_configs.LossConfig(
+          name='sparse_categorical_crossentropy'))
+  optimizer: base_configs.OptimizerConfig = dataclasses.field(
+      default_factory=lambda: base_configs.OptimizerConfig(
+          name='momentum',
+          decay=0.9,
+          epsilon=0.001,
+          momentum=0.9,
+          moving_average_decay=None))
+  learning_rate: base_configs.LearningRateConfig = dataclasses.field(
+      default_factory=lambda: base_configs.LearningRateConfig(
           name='piecewise_constant_with_warmup',
           examples_per_epoch=1281167,
           warmup_epochs=_RESNET_LR_WARMUP_EPOCHS,
@@ -18,7 +18,6 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import math
 from absl import app
 from absl import flags
 from absl import logging
@@ -45,6 +44,10 @@ flags.DEFINE_boolean(name='use_tf_function', default=True,
 flags.DEFINE_boolean(name='single_l2_loss_op', default=False,
                      help='Calculate L2_loss on concatenated weights, '
                      'instead of using Keras per-layer L2 loss.')
+flags.DEFINE_boolean(name='async_checkpoint', default=False,
+                     help='Write checkpoints on a background thread, '
+                     'overlapping the write with evaluation and summaries. '
+                     'Save errors are raised before the next training loop.')
 
 ############## TBD INSTRUMENTATION BEGIN ################
 flags.DEFINE_integer('profile_step', default=None,
@@ -92,8 +95,8 @@ def get_num_train_iterations(flags_obj):
     train_steps = min(flags_obj.train_steps, train_steps)
     train_epochs = 1
 
-  eval_steps = math.ceil(1.0 * imagenet_preprocessing.NUM_IMAGES['validation'] /
-                         flags_obj.batch_size)
+  eval_steps = -(-imagenet_preprocessing.NUM_IMAGES['validation'] //
+                 flags_obj.batch_size)
 
   return train_steps, train_epochs, eval_steps
 
@@ -119,6 +122,15 @@ def run(flags_obj):
   Returns:
     Dictionary of training and eval stats.
   """
+  # The data format is set before anything else so that no layer or dtype
+  # policy is created under the default NHWC layout.
+  # TODO(anj-s): Set data_format without using Keras.
+  data_format = flags_obj.data_format
+  if data_format is None:
+    data_format = ('channels_first' if tf.config.list_physical_devices('GPU')
+                   else 'channels_last')
+  tf.keras.backend.set_image_data_format(data_format)
+
   keras_utils.set_session_config(
       enable_xla=flags_obj.enable_xla)
   performance.set_mixed_precision_policy(flags_core.get_tf_dtype(flags_obj))
@@ -132,18 +144,21 @@ def run(flags_obj):
           datasets_num_private_threads=flags_obj.datasets_num_private_threads)
     common.set_cudnn_batchnorm_mode()
 
-  # TODO(anj-s): Set data_format without using Keras.
-  data_format = flags_obj.data_format
-  if data_format is None:
-    data_format = ('channels_first' if tf.config.list_physical_devices('GPU')
-                   else 'channels_last')
-  tf.keras.backend.set_image_data_format(data_format)
+  # Multi-GPU runs default to NCCL with at least two packs, so gradient packs
+  # are reduced over the NCCL ring while the remaining packs are still being
+  # produced.
+  all_reduce_alg = flags_obj.all_reduce_alg
+  num_packs = flags_obj.num_packs
+  if (flags_obj.distribution_strategy.lower() == 'mirrored' and
+      flags_obj.num_gpus > 1 and all_reduce_alg is None):
+    all_reduce_alg = 'nccl'
+    num_packs = max(2, num_packs)
 
   strategy = distribution_utils.get_distribution_strategy(
       distribution_strategy=flags_obj.distribution_strategy,
       num_gpus=flags_obj.num_gpus,
-      all_reduce_alg=flags_obj.all_reduce_alg,
-      num_packs=flags_obj.num_packs,
+      all_reduce_alg=all_reduce_alg,
+      num_packs=num_packs,
       tpu_address=flags_obj.tpu)
 
   per_epoch_steps, train_epochs, eval_steps = get_num_train_iterations(
@@ -162,6 +177,10 @@ def run(flags_obj):
   with distribution_utils.get_strategy_scope(strategy):
     runnable = resnet_runnable.ResnetRunnable(flags_obj, time_callback,
                                               per_epoch_steps)
+  if tf.keras.backend.image_data_format() != data_format:
+    raise ValueError('Image data format changed to %s while building the '
+                     'model, expected %s.' %
+                     (tf.keras.backend.image_data_format(), data_format))
 
   eval_interval = flags_obj.epochs_between_evals * per_epoch_steps
   checkpoint_interval = (
@@ -186,6 +205,7 @@ def run(flags_obj):
       summary_interval=summary_interval,
       eval_steps=eval_steps,
       eval_interval=eval_interval,
+      async_checkpoint=flags_obj.async_checkpoint,
       profile_step = flags_obj.profile_step)
 
   time_callback.on_train_begin()
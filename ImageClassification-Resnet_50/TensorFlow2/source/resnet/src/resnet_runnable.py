@@ -109,6 +109,23 @@ class ResnetRunnable(standard_runnable.StandardTrainable,
     self.epoch_steps = epoch_steps
     self.epoch_helper = utils.EpochHelper(epoch_steps, self.global_step)
 
+    # The forward pass is traced once for the static per-replica batch shape
+    # (the train dataset drops the remainder), so a short batch never
+    # triggers a retrace. With XLA the forward pass and loss (and, through the
+    # tape, the matching backward pass) are compiled into one cluster. The
+    # gradient allreduce stays outside of it.
+    self._forward_fn = tf.function(
+        self._forward,
+        input_signature=[
+            tf.TensorSpec([
+                self.batch_size, imagenet_preprocessing.DEFAULT_IMAGE_SIZE,
+                imagenet_preprocessing.DEFAULT_IMAGE_SIZE,
+                imagenet_preprocessing.NUM_CHANNELS
+            ], self.dtype),
+            tf.TensorSpec([self.batch_size, 1], tf.float32),
+        ],
+        experimental_compile=flags_obj.enable_xla)
+
   def build_train_dataset(self):
     """See base class."""
     return utils.make_distributed_dataset(
@@ -150,24 +167,7 @@ class ResnetRunnable(standard_runnable.StandardTrainable,
       """Function to run on the device."""
       images, labels = inputs
       with tf.GradientTape() as tape:
-        logits = self.model(images, training=True)
-
-        prediction_loss = tf.keras.losses.sparse_categorical_crossentropy(
-            labels, logits)
-        loss = tf.reduce_sum(prediction_loss) * (1.0 /
-                                                 self.flags_obj.batch_size)
-        num_replicas = self.strategy.num_replicas_in_sync
-        l2_weight_decay = 1e-4
-        if self.flags_obj.single_l2_loss_op:
-          l2_loss = l2_weight_decay * 2 * tf.add_n([
-              tf.nn.l2_loss(v)
-              for v in self.model.trainable_variables
-              if 'bn' not in v.name
-          ])
-
-          loss += (l2_loss / num_replicas)
-        else:
-          loss += (tf.reduce_sum(self.model.losses) / num_replicas)
+        logits, loss = self._forward_fn(images, labels)
 
       grad_utils.minimize_using_explicit_allreduce(
           tape, self.optimizer, loss, self.model.trainable_variables)
@@ -176,6 +176,30 @@ class ResnetRunnable(standard_runnable.StandardTrainable,
 
     self.strategy.run(step_fn, args=(next(iterator),))
 
+  def _forward(self, images, labels):
+    """Computes the logits and the per-replica training loss."""
+    logits = self.model(images, training=True)
+
+    prediction_loss = tf.keras.losses.sparse_categorical_crossentropy(
+        labels, logits)
+    loss = tf.reduce_sum(prediction_loss) * (1.0 / self.flags_obj.batch_size)
+    num_replicas = self.strategy.num_replicas_in_sync
+    l2_weight_decay = 1e-4
+    if self.flags_obj.single_l2_loss_op:
+      # One reduction over the concatenated weights instead of one l2_loss
+      # per variable. 2 * l2_loss(v) == sum(v ** 2).
+      flat_weights = tf.concat([
+          tf.reshape(v, [-1])
+          for v in self.model.trainable_variables
+          if 'bn' not in v.name
+      ], axis=0)
+      l2_loss = l2_weight_decay * tf.reduce_sum(tf.square(flat_weights))
+
+      loss += (l2_loss / num_replicas)
+    else:
+      loss += (tf.reduce_sum(self.model.losses) / num_replicas)
+    return logits, loss
+
   def train_loop_end(self):
     """See base class."""
     metrics = {
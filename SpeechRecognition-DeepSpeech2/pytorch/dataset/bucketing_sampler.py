@@ -1,6 +1,8 @@
+import os
+
 from torch.utils.data.sampler import Sampler
 import numpy as np
-from data_loader import SpectrogramDataset, load_audio
+from dataset.data_loader import SpectrogramDataset, load_audio
 from collections import defaultdict
 
 
@@ -40,3 +42,47 @@ class BucketingSampler(Sampler):
 
     def __len__(self):
         return len(self.data_source)
+
+
+class BucketingBatchSampler(Sampler):
+    def __init__(self, data_source, batch_size, bucket_batches=32, num_replicas=1, rank=0, seed=0):
+        """
+        Yields batches of utterances of similar length, so that little of each batch is padding.
+        Utterances are sorted by audio file size, a proxy for duration that needs no decoding, and cut
+        into buckets of bucket_batches batches. Batches are drawn from each shuffled bucket and the batch
+        order is shuffled every epoch.
+        :param data_source: The SpectrogramDataset to be sampled from
+        :param batch_size: Number of utterances per batch
+        :param bucket_batches: Number of batches per bucket
+        :param num_replicas: Number of distributed processes, each gets a disjoint share of the batches
+        :param rank: Rank of this process
+        :param seed: Shuffling seed, combined with the epoch given to set_epoch
+        """
+        super(BucketingBatchSampler, self).__init__(data_source)
+        audio_lengths = [os.path.getsize(path) for (path, _) in data_source.ids]
+        self.sorted_indices = np.argsort(audio_lengths, kind='stable')
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(self.sorted_indices), bucket_size):
+            bucket = self.sorted_indices[start:start + bucket_size].copy()
+            rng.shuffle(bucket)
+            batches.extend(bucket[b:b + self.batch_size].tolist() for b in range(0, len(bucket), self.batch_size))
+        rng.shuffle(batches)
+        # Every replica draws the same permutation and keeps every num_replicas-th batch
+        return iter(batches[self.rank:len(self) * self.num_replicas:self.num_replicas])
+
+    def __len__(self):
+        num_batches = (len(self.sorted_indices) + self.batch_size - 1) // self.batch_size
+        return num_batches // self.num_replicas
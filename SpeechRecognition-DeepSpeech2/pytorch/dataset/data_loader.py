@@ -1,4 +1,8 @@
+import hashlib
+import json
 import os
+import time
+from functools import partial
 from tempfile import NamedTemporaryFile
 
 import librosa
@@ -131,8 +135,23 @@ class SpectrogramParser(AudioParser):
         raise NotImplementedError
 
 
+def feature_path(feature_dir, audio_path):
+    return os.path.join(feature_dir, os.path.splitext(os.path.basename(audio_path))[0] + '.npy')
+
+
+def feature_cache_dir(cache_root, dataset):
+    """
+    Returns the directory under cache_root holding the cached spectrograms of dataset.
+    It is named after a hash of the audio config, the normalization and the manifest path and entries,
+    so changing any of them never serves spectrograms, or shard markers, from the old settings.
+    """
+    key = json.dumps([dataset.audio_conf, dataset.normalize, os.path.abspath(dataset.manifest_filepath),
+                      dataset.ids], sort_keys=True, default=str)
+    return os.path.join(cache_root, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
 class SpectrogramDataset(Dataset, SpectrogramParser):
-    def __init__(self, audio_conf, manifest_filepath, labels, normalize=False, augment=False):
+    def __init__(self, audio_conf, manifest_filepath, labels, normalize=False, augment=False, feature_dir=None):
         """
         Dataset that loads tensors via a csv containing file paths to audio files and transcripts separated by
         a comma. Each new line is a different sample. Example below:
@@ -145,19 +164,27 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         :param labels: String containing all the possible characters to map to
         :param normalize: Apply standard mean and deviation normalization to audio tensor
         :param augment(default False):  Apply random tempo and gain perturbations
+        :param feature_dir(default None): Read spectrograms written by preprocess_to_shm from this directory
         """
         with open(manifest_filepath) as f:
             ids = f.readlines()
         ids = [x.strip().split(',') for x in ids]
         self.ids = ids
         self.size = len(ids)
+        self.audio_conf = audio_conf
+        self.manifest_filepath = manifest_filepath
         self.labels_map = dict([(labels[i], i) for i in range(len(labels))])
+        self.feature_dir = feature_dir
         super(SpectrogramDataset, self).__init__(audio_conf, normalize, augment)
 
     def __getitem__(self, index):
         sample = self.ids[index]
         audio_path, transcript_path = sample[0], sample[1]
-        spect = self.parse_audio(audio_path)
+        if self.feature_dir is not None:
+            spect = np.load(feature_path(self.feature_dir, audio_path), mmap_mode='r')
+            spect = torch.from_numpy(spect.astype(np.float32))
+        else:
+            spect = self.parse_audio(audio_path)
         transcript = self.parse_transcript(transcript_path)
         return spect, transcript
 
@@ -261,38 +288,47 @@ def _collate_fn_paths(batch):
     return inputs, targets, input_percentages, target_sizes, paths, None
 
 
-def _collate_fn(batch):
+def _round_up(seq_length, multiple):
+    return (seq_length + multiple - 1) // multiple * multiple
+
+
+def _collate_fn(batch, pad_multiple=1):
     def func(p):
         return p[0].size(1)
 
     longest_sample = max(batch, key=func)[0]
     freq_size = longest_sample.size(0)
     minibatch_size = len(batch)
-    max_seqlength = longest_sample.size(1)
+    max_seqlength = _round_up(longest_sample.size(1), pad_multiple)
     inputs = torch.zeros(minibatch_size, 1, freq_size, max_seqlength)
     input_percentages = torch.FloatTensor(minibatch_size)
-    target_sizes = torch.IntTensor(minibatch_size)
-    targets = []
     for x in range(minibatch_size):
-        sample = batch[x]
-        tensor = sample[0]
-        target = sample[1]
+        tensor = batch[x][0]
         seq_length = tensor.size(1)
         inputs[x][0].narrow(1, 0, seq_length).copy_(tensor)
         input_percentages[x] = seq_length / float(max_seqlength)
-        target_sizes[x] = len(target)
-        targets.extend(target)
-    targets = torch.IntTensor(targets)
+    # Flattened int32 targets, ready for CTCLoss once copied to the GPU
+    targets = torch.cat([torch.as_tensor(sample[1], dtype=torch.int32) for sample in batch])
+    target_sizes = torch.as_tensor([len(sample[1]) for sample in batch], dtype=torch.int32)
     return inputs, targets, input_percentages, target_sizes
 
 
+def seed_worker(worker_id):
+    """
+    Gives every loader worker its own numpy seed so augmentation differs per worker.
+    """
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
 class AudioDataLoader(DataLoader):
     def __init__(self, *args, **kwargs):
         """
         Creates a data loader for AudioDatasets.
+        pad_multiple rounds the padded time axis of each batch up to a multiple of it.
         """
+        pad_multiple = kwargs.pop('pad_multiple', 1)
         super(AudioDataLoader, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn
+        self.collate_fn = partial(_collate_fn, pad_multiple=pad_multiple)
 
 
 class AudioDataAndLogitsLoader(DataLoader):
@@ -313,6 +349,149 @@ class AudioDataAndPathsLoader(DataLoader):
         self.collate_fn = _collate_fn_paths
 
 
+def _shard_marker(out_dir, shard, num_shards):
+    return os.path.join(out_dir, '.done-{}-of-{}'.format(shard, num_shards))
+
+
+def preprocess_to_shm(dataset, out_dir='/dev/shm/ds2_feats', shard=0, num_shards=1):
+    """
+    Writes the spectrogram of every utterance of a non-augmented dataset to out_dir as a float16 .npy file,
+    so later epochs and runs can mmap it instead of decoding the audio again.
+    Only every num_shards-th utterance starting at shard is written, so the processes of a node can fill the
+    cache together; a marker file records that the shard is complete (see wait_for_feature_cache).
+    Utterances that already have a file are skipped.
+    """
+    if dataset.augment:
+        raise ValueError("Augmented spectrograms change every epoch and cannot be cached")
+    os.makedirs(out_dir, exist_ok=True)
+    for audio_path, _ in dataset.ids[shard::num_shards]:
+        path = feature_path(out_dir, audio_path)
+        if os.path.exists(path):
+            continue
+        spect = dataset.parse_audio(audio_path).numpy().astype(np.float16)
+        # Write under a temporary name so an interrupted run never leaves a truncated file behind
+        tmp_path = '{}.{}.tmp.npy'.format(path, os.getpid())
+        np.save(tmp_path, spect)
+        os.rename(tmp_path, path)
+    open(_shard_marker(out_dir, shard, num_shards), 'w').close()
+
+
+def wait_for_feature_cache(out_dir, num_shards, poll_interval=5.0):
+    """
+    Blocks until preprocess_to_shm has completed all num_shards shards of out_dir.
+    """
+    while not all(os.path.exists(_shard_marker(out_dir, shard, num_shards)) for shard in range(num_shards)):
+        time.sleep(poll_interval)
+
+
+def precompute_spectrograms(dataset, dtype=torch.float32):
+    """
+    Computes every spectrogram of a non-augmented dataset once and keeps them in memory as dtype.
+    Utterances are concatenated along the time axis instead of padded to the longest one.
+    Returns the (F x total frames) spectrograms, the frame count of each utterance,
+    the flattened transcripts and the transcript lengths.
+    """
+    specs, lengths, targets, target_sizes = [], [], [], []
+    for index in range(len(dataset)):
+        spect, transcript = dataset[index]
+        specs.append(spect.to(dtype))
+        lengths.append(spect.size(1))
+        targets.extend(transcript)
+        target_sizes.append(len(transcript))
+    return (torch.cat(specs, 1), torch.LongTensor(lengths),
+            torch.IntTensor(targets), torch.IntTensor(target_sizes))
+
+
+class TensorDataLoader(object):
+    def __init__(self, specs, lengths, targets, target_sizes, batch_size=1, sampler=None, batch_sampler=None,
+                 pin_memory=False, pad_multiple=1):
+        """
+        Serves batches from the output of precompute_spectrograms, in the same format as AudioDataLoader.
+        Batches come from the batch_sampler if one is given. Otherwise indices come from the sampler,
+        or from a fresh permutation every epoch, and are cut into batches of batch_size.
+        """
+        self.specs = specs
+        self.lengths = lengths
+        self.targets = targets
+        self.target_sizes = target_sizes
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        # Like DataLoader, pinning is skipped on hosts without CUDA
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.pad_multiple = pad_multiple
+        self.frame_offsets = torch.cumsum(lengths, 0) - lengths
+        self.target_offsets = torch.cumsum(target_sizes.long(), 0) - target_sizes.long()
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        num_samples = len(self.sampler) if self.sampler is not None else self.lengths.size(0)
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+    def _make_batch(self, indices):
+        lengths = self.lengths[indices]
+        max_seqlength = _round_up(int(lengths.max()), self.pad_multiple)
+        inputs = torch.zeros(len(indices), 1, self.specs.size(0), max_seqlength)
+        targets = []
+        for x, index in enumerate(indices.tolist()):
+            seq_length = int(lengths[x])
+            frame_offset = int(self.frame_offsets[index])
+            inputs[x][0].narrow(1, 0, seq_length).copy_(self.specs.narrow(1, frame_offset, seq_length))
+            target_offset = int(self.target_offsets[index])
+            targets.append(self.targets.narrow(0, target_offset, int(self.target_sizes[index])))
+        batch = (inputs, torch.cat(targets), lengths.float() / max_seqlength, self.target_sizes[indices])
+        if self.pin_memory:
+            batch = tuple(tensor.pin_memory() for tensor in batch)
+        return batch
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            for indices in self.batch_sampler:
+                yield self._make_batch(torch.LongTensor(indices))
+            return
+        if self.sampler is not None:
+            order = torch.LongTensor(list(self.sampler))
+        else:
+            order = torch.randperm(self.lengths.size(0))
+        for start in range(0, order.size(0), self.batch_size):
+            yield self._make_batch(order[start:start + self.batch_size])
+
+
+class CudaPrefetcher(object):
+    def __init__(self, loader):
+        """
+        Wraps an AudioDataLoader built with pin_memory=True and copies the next
+        batch to the GPU on a side stream while the current batch trains.
+        """
+        self.loader = loader
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return tuple(tensor.cuda(non_blocking=True) for tensor in batch)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            # The copies were issued on the side stream; tell the allocator the
+            # compute stream uses them now so the memory is not reused early.
+            for tensor in batch:
+                tensor.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+
 def augment_audio_with_sox(path, sample_rate, tempo, gain):
     """
     Changes tempo and gain of the recording with sox and loads it.
@@ -21,7 +21,6 @@ def eval_model(model, test_loader, decoder):
     # For each batch in the test_loader, make a prediction and calculate the WER CER
     for data in test_loader:
         inputs, targets, input_percentages, target_sizes = data
-        inputs = torch.Tensor(inputs)
 
         # unflatten targets
         split_targets = []
@@ -31,7 +30,7 @@ def eval_model(model, test_loader, decoder):
             offset += size
 
         if cuda:
-            inputs = inputs.cuda()
+            inputs = inputs.cuda(non_blocking=True)
 
         out = model(inputs)
         out = out.transpose(0, 1)  # TxNxH
@@ -201,6 +201,7 @@ class DeepSpeech(nn.Module):
 
     def forward(self, x):
         x = self.conv(x)
+        x = x.contiguous()  # the conv stack may run channels-last
 
         sizes = x.size()
         x = x.view(sizes[0], sizes[1] * sizes[2], sizes[3])  # Collapse feature dimension
@@ -247,8 +248,8 @@ class DeepSpeech(nn.Module):
     @staticmethod
     def serialize(model, optimizer=None, epoch=None, iteration=None, loss_results=None,
                   cer_results=None, wer_results=None, avg_loss=None, meta=None):
-        model_is_cuda = next(model.parameters()).is_cuda
-        model = model.module if model_is_cuda else model
+        # Unwrap DataParallel/DistributedDataParallel
+        model = model.module if hasattr(model, 'module') else model
         package = {
             'version': model.version,
             'hidden_size': model.hidden_size,
@@ -3,6 +3,7 @@
 
 RANDOM_SEED=1
 TARGET_ACC=23
+NUM_GPUS=${NUM_GPUS:-1}
 
 # ARG		CHOICE				HELP
 # ${1} = integer				Looks for a model at new_training/deepspeech_${1}.pth.tar
@@ -11,13 +12,13 @@ MODELS="."
 if [ "${1}" = "new" ]
 then
 	echo "Traning new model..."
-	python training.py \
+	torchrun --standalone --nproc_per_node=$NUM_GPUS training.py \
 	    --checkpoint \
 	    --model_path ${MODELS}/deepspeech_t$RANDOM_SEED.pth \
 	    --seed $RANDOM_SEED --acc $TARGET_ACC
 else
 	echo "Traning from "${1}"..."
-	python training.py \
+	torchrun --standalone --nproc_per_node=$NUM_GPUS training.py \
 	    --checkpoint \
 	    --continue_from ${MODELS}/deepspeech_${1}.pth \
 	    --model_path MODELS/deepspeech_t$RANDOM_SEED.pth \
@@ -1,31 +1,74 @@
 import argparse
+import contextlib
+import math
+import os
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append('../')
 
 import torch
-from warpctc_pytorch import CTCLoss
-
-from dataset.data_loader import AudioDataLoader, SpectrogramDataset
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn import CTCLoss
+from torch.nn.parallel import DistributedDataParallel
+
+from dataset.bucketing_sampler import BucketingBatchSampler
+from dataset.data_loader import AudioDataLoader, CudaPrefetcher, SpectrogramDataset, TensorDataLoader, \
+    feature_cache_dir, precompute_spectrograms, preprocess_to_shm, seed_worker, wait_for_feature_cache
 from model.decoder import GreedyDecoder
 import model.params as params
 from model.eval_model import eval_model
 from model.utils import *
 
 
+def copy_to_cpu(obj):
+    """
+    Deep-copies the tensors of a checkpoint package to the CPU so it can be written while training continues.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copy = type(obj)((key, copy_to_cpu(value)) for key, value in obj.items())
+        if hasattr(obj, '_metadata'):
+            copy._metadata = obj._metadata  # state_dict version info used by load_state_dict
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value) for value in obj)
+    return obj
+
 
 def main(args):
+    # One process per GPU, launched with torchrun (or torch.distributed.launch)
+    args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if args.distributed:
+        dist.init_process_group(backend='nccl', init_method='env://')
+        torch.cuda.set_device(args.local_rank)
+    is_main_process = not args.distributed or dist.get_rank() == 0
+
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
 
     args.checks_per_epoch = max(1, args.checks_per_epoch)
 
-    loss_results = torch.Tensor(params.epochs)
-    cer_results = torch.Tensor(params.epochs)
-    wer_results = torch.Tensor(params.epochs)
+    loss_results = torch.zeros(params.epochs, dtype=torch.float32)
+    cer_results = torch.zeros(params.epochs, dtype=torch.float32)
+    wer_results = torch.zeros(params.epochs, dtype=torch.float32)
     best_wer = None
     make_folder(args.save_folder)
 
+    # Checkpoints are written by a single background thread; waiting on the
+    # previous write before submitting the next keeps them in order
+    checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+
+    def save_checkpoint(package, path):
+        nonlocal pending_save
+        package = copy_to_cpu(package)
+        if pending_save is not None:
+            pending_save.result()
+        pending_save = checkpoint_writer.submit(torch.save, package, path)
+
     labels = get_labels(params)
     audio_conf = get_audio_conf(params)
 
@@ -42,12 +85,54 @@ def main(args):
                                       labels=labels,
                                       normalize=True,
                                       augment=False)
-    train_loader = AudioDataLoader(train_dataset,
-                                   batch_size=params.batch_size,
-                                   num_workers=1)
+    if args.feature_cache:
+        # Decode and transform each utterance once, later reads are mmaps from the RAM disk.
+        # The RAM disk is per node, so the processes of every node split the utterances between them
+        # and wait on the shard marker files rather than on a collective that could time out.
+        cached_datasets = [test_dataset] if params.augment else [train_dataset, test_dataset]
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        if is_main_process:
+            print("Caching spectrograms in {}".format(args.feature_cache))
+        for dataset in cached_datasets:
+            dataset_dir = feature_cache_dir(args.feature_cache, dataset)
+            preprocess_to_shm(dataset, dataset_dir, shard=args.local_rank, num_shards=local_world_size)
+        for dataset in cached_datasets:
+            dataset_dir = feature_cache_dir(args.feature_cache, dataset)
+            wait_for_feature_cache(dataset_dir, local_world_size)
+            dataset.feature_dir = dataset_dir
+    # Batching utterances of similar length keeps the padded frames per batch low
+    train_sampler = BucketingBatchSampler(train_dataset, params.batch_size,
+                                          num_replicas=dist.get_world_size() if args.distributed else 1,
+                                          rank=dist.get_rank() if args.distributed else 0,
+                                          seed=args.seed)
+    if params.augment or not args.precompute_spectrograms:
+        train_loader = AudioDataLoader(train_dataset,
+                                       batch_sampler=train_sampler,
+                                       num_workers=min(os.cpu_count(), 8),
+                                       prefetch_factor=4,
+                                       persistent_workers=True,
+                                       worker_init_fn=seed_worker,
+                                       pin_memory=True,
+                                       pad_multiple=16)
+    else:
+        # Without augmentation every epoch sees the same spectrograms, so compute them once.
+        # Every process holds its own copy; spectrograms read from the float16 feature cache stay float16.
+        if is_main_process:
+            print("Precomputing training spectrograms...")
+        spect_dtype = torch.float16 if args.feature_cache else torch.float32
+        train_loader = TensorDataLoader(*precompute_spectrograms(train_dataset, spect_dtype),
+                                        batch_sampler=train_sampler,
+                                        pin_memory=True,
+                                        pad_multiple=16)
+    # Fewer validation workers leave CPU headroom for the training workers
     test_loader = AudioDataLoader(test_dataset,
                                   batch_size=val_batch_size,
-                                  num_workers=1)
+                                  num_workers=2,
+                                  prefetch_factor=4,
+                                  persistent_workers=True,
+                                  pin_memory=True)
+    # Batch i+1 is copied to the GPU while batch i trains
+    train_batches = CudaPrefetcher(train_loader) if params.cuda else train_loader
 
     model = get_model(params)
 
@@ -56,11 +141,12 @@ def main(args):
         print("***{} = {} ".format(arg.ljust(25), getattr(args, arg)))
     print("=======================================================")
 
-    criterion = CTCLoss()
+    # zero_infinity drops impossible alignments instead of producing inf losses
+    criterion = CTCLoss(blank=0, zero_infinity=True, reduction='sum')
     parameters = model.parameters()
     optimizer = torch.optim.SGD(parameters, lr=params.lr,
                                 momentum=params.momentum, nesterov=True,
-                                weight_decay=params.l2)
+                                weight_decay=params.l2, foreach=True)
     decoder = GreedyDecoder(labels)
 
     if args.continue_from:
@@ -76,7 +162,7 @@ def main(args):
             start_iter = 0
         else:
             start_iter += 1
-        avg_loss = int(package.get('avg_loss', 0))
+        avg_loss = float(package.get('avg_loss', 0.0))
 
         if args.start_epoch != -1:
             start_epoch = args.start_epoch
@@ -87,11 +173,21 @@ def main(args):
         print(loss_results)
 
     else:
-        avg_loss = 0
+        avg_loss = 0.0
         start_epoch = 0
         start_iter = 0
     if params.cuda:
-        model = torch.nn.DataParallel(model).cuda()
+        model = model.cuda()
+        model = model.to(memory_format=torch.channels_last)
+        if args.distributed:
+            model = DistributedDataParallel(model, device_ids=[args.local_rank],
+                                            output_device=args.local_rank,
+                                            bucket_cap_mb=50)
+    # Utterance lengths still give over a hundred padded batch shapes, too many
+    # to record a CUDA graph for each, so the graph is compiled once with a
+    # dynamic batch and time axis instead. Evaluation and serialization keep
+    # using the uncompiled module.
+    compiled_model = torch.compile(model, dynamic=True)
 
     print(model)
     print("Number of parameters: {}".format(DeepSpeech.get_param_size(model)))
@@ -100,68 +196,89 @@ def main(args):
     data_time = AverageMeter()
     losses = AverageMeter()
     ctc_time = AverageMeter()
+    scaler = torch.cuda.amp.GradScaler(enabled=params.cuda)
+    # On the GPU, batch time is read from CUDA events on logging steps only,
+    # so the loop never has to drain the GPU just to time itself
+    if params.cuda:
+        start_event = torch.cuda.Event(enable_timing=True)
+        end_event = torch.cuda.Event(enable_timing=True)
 
     for epoch in range(start_epoch, params.epochs):
+        train_sampler.set_epoch(epoch)
         model.train()
         end = time.time()
-        for i, (data) in enumerate(train_loader, start=start_iter):
+        for i, (data) in enumerate(train_batches, start=start_iter):
             if i == len(train_loader):
                 break
             inputs, targets, input_percentages, target_sizes = data
             # measure data loading time
             data_time.update(time.time() - end)
-            inputs = torch.Tensor(inputs, requires_grad=False)
-            target_sizes = torch.Tensor(target_sizes, requires_grad=False)
-            targets = torch.Tensor(targets, requires_grad=False)
-
+            step_start = time.time()
             if params.cuda:
-                inputs = inputs.cuda()
+                start_event.record()
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
+
+            # Gradients are accumulated over accum_steps batches and only
+            # all-reduced and applied on the last one
+            update_step = (i + 1) % args.accum_steps == 0 or i + 1 == len(train_loader)
+            if args.distributed and not update_step:
+                sync_context = model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
 
-            out = model(inputs)
-            out = out.transpose(0, 1)  # TxNxH
+            with sync_context:
+                with torch.cuda.amp.autocast(enabled=params.cuda):
+                    out = compiled_model(inputs)
+                    out = out.transpose(0, 1)  # TxNxH
+                out = out.float()  # the CTC loss needs FP32 activations
 
-            seq_length = out.size(0)
-            sizes = torch.Tensor(input_percentages.mul_(int(seq_length)).int(), requires_grad=False)
+                seq_length = out.size(0)
+                sizes = (input_percentages * seq_length).to(torch.int32)
 
-            ctc_start_time = time.time()
-            loss = criterion(out, targets, sizes, target_sizes)
-            ctc_time.update(time.time() - ctc_start_time)
+                ctc_start_time = time.time()
+                loss = criterion(F.log_softmax(out, dim=-1), targets, sizes, target_sizes)
+                ctc_time.update(time.time() - ctc_start_time)
 
-            loss = loss / inputs.size(0)  # average the loss by minibatch
+                loss = loss / inputs.size(0)  # average the loss by minibatch
 
-            loss_sum = loss.data.sum()
-            inf = float("inf")
-            if loss_sum == inf or loss_sum == -inf:
-                print("WARNING: received an inf loss, setting loss value to 0")
-                loss_value = 0
-            else:
-                loss_value = loss.data[0]
+                # The one host sync of the step; zero_infinity covers inf but not NaN
+                loss_value = loss.item()
+                if not math.isfinite(loss_value):
+                    print("WARNING: received a non-finite loss, setting loss value to 0")
+                    loss_value = 0.0
 
-            avg_loss += loss_value
-            losses.update(loss_value, inputs.size(0))
+                avg_loss += loss_value
+                losses.update(loss_value, inputs.size(0))
 
-            # compute gradient
-            optimizer.zero_grad()
-            loss.backward()
+                # compute gradient
+                scaler.scale(loss / args.accum_steps).backward()
 
-            torch.nn.utils.clip_grad_norm(model.parameters(), params.max_norm)
-            # SGD step
-            optimizer.step()
+            if update_step:
+                # Clip the real gradients, not the scaled ones
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), params.max_norm, foreach=True)
+                # SGD step, skipped by the scaler if the gradients overflowed
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
             if params.cuda:
-                torch.cuda.synchronize()
-
-            # measure elapsed time
-            batch_time.update(time.time() - end)
+                end_event.record()
             end = time.time()
 
-            print('Epoch: [{0}][{1}/{2}]\t'
-                  'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
-                  'CTC Time {ctc_time.val:.3f} ({ctc_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
-                (epoch + 1), (i + 1), len(train_loader), batch_time=batch_time,
-                data_time=data_time, ctc_time=ctc_time, loss=losses))
+            if is_main_process and (i + 1) % args.print_freq == 0:
+                if params.cuda:
+                    end_event.synchronize()
+                    batch_time.update(start_event.elapsed_time(end_event) / 1000.0)
+                else:
+                    batch_time.update(end - step_start)
+                print('Epoch: [{0}][{1}/{2}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
+                      'CTC Time {ctc_time.val:.3f} ({ctc_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'.format(
+                    (epoch + 1), (i + 1), len(train_loader), batch_time=batch_time,
+                    data_time=data_time, ctc_time=ctc_time, loss=losses))
 
         avg_loss /= len(train_loader)
 
@@ -186,35 +303,39 @@ def main(args):
               'Average CER {cer:.3f}\t'.format(
             epoch + 1, wer=wer, cer=cer))
 
-        if args.checkpoint:
+        if args.checkpoint and is_main_process:
             file_path = '{}/deepspeech_{}.pth'.format(args.save_folder, epoch + 1)
-            torch.save(DeepSpeech.serialize(model, optimizer=optimizer, epoch=epoch, loss_results=loss_results,
-                                            wer_results=wer_results, cer_results=cer_results),
-                       file_path)
-        # anneal lr
-        optim_state = optimizer.state_dict()
-        optim_state['param_groups'][0]['lr'] = optim_state['param_groups'][0]['lr'] / params.learning_anneal
-        optimizer.load_state_dict(optim_state)
-        print('Learning rate annealed to: {lr:.6f}'.format(lr=optim_state['param_groups'][0]['lr']))
+            save_checkpoint(DeepSpeech.serialize(model, optimizer=optimizer, epoch=epoch, loss_results=loss_results,
+                                                 wer_results=wer_results, cer_results=cer_results),
+                            file_path)
+        # anneal lr in place, without round-tripping the momentum buffers through state_dict
+        for param_group in optimizer.param_groups:
+            param_group['lr'] /= params.learning_anneal
+        print('Learning rate annealed to: {lr:.6f}'.format(lr=optimizer.param_groups[0]['lr']))
 
         if best_wer is None or best_wer > wer:
-            print("Found better validated model, saving to {}".format(args.model_path))
-            torch.save(DeepSpeech.serialize(model,
-                                            optimizer=optimizer,
-                                            epoch=epoch,
-                                            loss_results=loss_results,
-                                            wer_results=wer_results,
-                                            cer_results=cer_results),
-                       args.model_path)
+            if is_main_process:
+                print("Found better validated model, saving to {}".format(args.model_path))
+                save_checkpoint(DeepSpeech.serialize(model,
+                                                     optimizer=optimizer,
+                                                     epoch=epoch,
+                                                     loss_results=loss_results,
+                                                     wer_results=wer_results,
+                                                     cer_results=cer_results),
+                                args.model_path)
             best_wer = wer
 
-        avg_loss = 0
+        avg_loss = 0.0
         model.train()
 
         # If set to exit at a given accuracy, exit
         if params.exit_at_acc and (best_wer <= args.acc):
             break
 
+    checkpoint_writer.shutdown(wait=True)
+    if pending_save is not None:
+        pending_save.result()  # re-raise any error from the last write
+
     print("=======================================================")
     print("***Best WER = ", best_wer)
     for arg in vars(args):
@@ -240,5 +361,19 @@ if __name__ == '__main__':
                         type=int, help='Number of epochs at which to start from')
     parser.add_argument('--checks_per_epoch', default=4,
                         type=int, help='Number of checkpoints to evaluate and save per epoch')
+    parser.add_argument('--accum_steps', default=1,
+                        type=int, help='Number of batches to accumulate gradients over before each update')
+    parser.add_argument('--feature_cache', default='',
+                        help='Directory (e.g. /dev/shm/ds2_feats) to cache non-augmented spectrograms in as float16, '
+                             'empty to disable. Changes validation WER slightly and needs room for the whole '
+                             'dataset besides the shared memory used by the DataLoader workers')
+    parser.add_argument('--precompute_spectrograms', action='store_true',
+                        help='Without augmentation, hold every training spectrogram in memory in each process '
+                             'instead of loading batches with DataLoader workers')
+    parser.add_argument('--print_freq', default=10,
+                        type=int, help='Number of iterations between progress reports')
+    parser.add_argument('--local-rank', '--local_rank', dest='local_rank',
+                        default=int(os.environ.get('LOCAL_RANK', 0)),
+                        type=int, help='GPU used by this process, set by torchrun through LOCAL_RANK')
     args = parser.parse_args()
     main(args)